@@ -1,25 +1,150 @@
 import math
 import re
+import sys
 import time
 import threading
 import datetime
+import functools
 import logging
-from collections import deque
-from typing import List, Dict, Optional, Any
+import queue
+from types import MappingProxyType
+from typing import List, Dict, Optional, Any, Tuple, Mapping, Iterable
+from zoneinfo import ZoneInfo
 
-import pytz
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
 from ibapi.contract import Contract, ContractDetails
 from ibapi.common import BarData
 
+try:
+    import numpy as np  # type: ignore
+
+    _HAS_NUMPY = True
+except ImportError:  # 選用依賴：僅 getPositionsAsArrays() 需要
+    _HAS_NUMPY = False
+
 # 常量定義
 TICK_LIST_OPT = "101,106,165,221,225,233,236,258,293,294,411,456"
 TIMEOUT = 5.0  # 單檔行情等待秒數
+SERVER_TIME_EXTRAPOLATE_SEC = 60.0  # 連線中、距上次 reqCurrentTime 未滿此秒數就外推
+STREAM_FLUSH_SEC = 0.01  # 長駐訂閱快照的發佈間隔（同一期間內的多筆 tick 合併發佈一次）
+TRADING_HOURS_TTL = 12 * 3600  # tradingHours 快取秒數（同一交易日內不重查）
+_RTH_OPEN = datetime.time(9, 30)  # 正規時段開盤（ET）
+_RTH_CLOSE_GRACE = datetime.time(16, 5)  # 收盤後仍以成交確認的寬限
+_RTH_OPEN_SEC = 9 * 3600 + 30 * 60  # 正規時段（ET 當日秒數，判斷時免建 time 物件）
+_RTH_CLOSE_SEC = 16 * 3600
 DEBUG = False
+_TICK_TABLE_SIZE = 128  # IB tick type id 皆小於此值，超出者退回字串格式化
 
 log = logging.getLogger(__name__)
 
+_EMPTY: Mapping[str, Any] = MappingProxyType({})  # 尚無快照時的共用唯讀空表
+
+_RANGE_RE = re.compile(
+    r"^(?P<sdate>\d{8}):(?P<stime>\d{4})-(?:(?P<edate>\d{8}):)?(?P<etime>\d{4})$"
+)
+
+
+@functools.lru_cache(maxsize=256)  # 每檔合約每日一筆
+def _todays_trading_windows(
+    trading_hours: str, today: str, tz: datetime.tzinfo
+) -> Tuple[Tuple[float, float], ...]:
+    """
+    取出 tradingHours 中以 today 開頭的區段，轉成 (start_epoch, end_epoch)；
+    同一天同一字串重複查詢直接命中快取，比對只剩兩次浮點比較。
+    """
+    windows = []
+    for rng in trading_hours.replace(";", ",").split(","):
+        rng = rng.strip()
+        if not rng.startswith(today) or rng.endswith("CLOSED"):
+            continue
+        m = _RANGE_RE.match(rng)
+        if not m:
+            continue
+        windows.append(
+            (
+                _hhmm_epoch(m["sdate"], m["stime"], tz),
+                _hhmm_epoch(m["edate"] or m["sdate"], m["etime"], tz),
+            )
+        )
+    return tuple(windows)
+
+
+def _hhmm_epoch(yyyymmdd: str, hhmm: str, tz: datetime.tzinfo) -> float:
+    """'YYYYMMDD' + 'HHMM'（tz 當地時間）-> epoch 秒；直接切片取數字，不經 strptime"""
+    return datetime.datetime(
+        int(yyyymmdd[:4]),
+        int(yyyymmdd[4:6]),
+        int(yyyymmdd[6:8]),
+        int(hhmm[:2]),
+        int(hhmm[2:]),
+        tzinfo=tz,
+    ).timestamp()
+
+
+def _snapshot_ready(d: Dict[str, Any], is_opt: bool) -> bool:
+    """snapshot 就緒：已有 last/bid/ask 任一價格；期權另需 delta"""
+    if "last" not in d and "bid" not in d and "ask" not in d:
+        return False
+    return not is_opt or d.get("delta") is not None
+
+
+class _PositionRec:
+    """
+    單筆持倉（__slots__，不帶每筆 dict）：
+    - 以屬性存取：rec.symbol
+    - 相容原 dict 介面：rec["symbol"] / rec.get("multiplier")
+    """
+
+    __slots__ = (
+        "account",
+        "conId",
+        "secType",
+        "symbol",
+        "lastTradeDateOrContractMonth",
+        "strike",
+        "right",
+        "exchange",
+        "currency",
+        "position",
+        "avgCost",
+        "tradingClass",
+        "multiplier",
+    )
+
+    def __init__(self, account: str, contract: Contract, pos: float, avgCost: float):
+        self.account = account
+        self.conId = contract.conId
+        self.secType = contract.secType
+        self.symbol = contract.symbol
+        self.lastTradeDateOrContractMonth = contract.lastTradeDateOrContractMonth
+        self.strike = contract.strike
+        self.right = contract.right
+        self.exchange = contract.exchange
+        self.currency = contract.currency
+        self.position = pos
+        self.avgCost = avgCost
+        self.tradingClass = contract.tradingClass
+        self.multiplier = contract.multiplier
+
+    def __getitem__(self, name: str) -> Any:
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return getattr(self, name, default)
+
+
+# getPositionsAsArrays() 的數值欄位 dtype；其餘欄位為 object
+_POSITION_DTYPES = {
+    "conId": "int64",
+    "strike": "float64",
+    "position": "float64",
+    "avgCost": "float64",
+}
+
 
 class IBApp(EWrapper, EClient):
     """
@@ -74,24 +199,38 @@ class IBApp(EWrapper, EClient):
         # 市場資料/狀態
         self.tickers: Dict[int, Dict[str, Any]] = {}
         self._stream_key_map: Dict[int, str] = {}
-        self._stream_data: Dict[str, Dict[str, Any]] = {}
+        self._stream_data: Dict[str, Mapping[str, Any]] = {}  # 唯讀快照
+        self._stream_dirty: set = set()  # 有新 tick、待發佈的訂閱 reqId
+        self._stream_flusher: Optional[threading.Thread] = None
+        self._stream_wake = threading.Event()  # tick 標記 dirty 時 set，發佈執行緒閒置時不輪詢
+        # 發佈與 unsubscribe 互斥：已取消的 key 不會被遲到的發佈寫回 _stream_data
+        self._stream_lock = threading.Lock()
+        # 等昨收的訂閱 key -> 事件（發佈到含 prev_close/close 的快照時 set）
+        self._close_events: Dict[str, threading.Event] = {}
+        # snapshot 等待者：reqId -> (就緒事件, 是否為期權)
+        self._snapshot_waiters: Dict[int, Tuple[threading.Event, bool]] = {}
         self.market_status = {"is_open": False, "next_open": None, "last_check": None}
 
         # 回傳資料隊列
-        self.contract_details: List[ContractDetails] = []
-        self.contract_details_queue = deque()
-        self.contract_details_available = threading.Event()
-        self.current_time_queue = deque()
-        self.current_time_available = threading.Event()
-        self.historical_data_queue = deque()
-        self.historical_data_available = threading.Event()
-        self.historical_data_end_available = threading.Event()
+        # 合約細節等待者：reqId -> (End 事件, 收集中的 details)，並行請求互不干擾
+        self._cd_waiters: Dict[int, Tuple[threading.Event, List[ContractDetails]]] = {}
+        # currentTime 回調直接 put，get_server_time 以 get(timeout) 一次完成等待與取值
+        self._current_time_q: "queue.SimpleQueue[int]" = queue.SimpleQueue()
+        # 歷史資料按 reqId 分流：reqId -> End 事件；未登記的 reqId 回覆直接忽略
+        self._hist_end_events: Dict[int, threading.Event] = {}
+        # 只需最後一根 K 的請求：reqId -> 最新 bar（不累積整段序列）
+        self._last_bar_only: Dict[int, Optional[BarData]] = {}
+        # (symbol, 日期) -> (monotonic 取得時間, tradingHours)
+        self._th_cache: Dict[Tuple[Any, datetime.date], Tuple[float, str]] = {}
 
         # 時區
-        self.us_eastern = pytz.timezone("US/Eastern")
+        self.us_eastern = ZoneInfo("America/New_York")  # 正式 IANA 名稱；US/Eastern 只是 backward 別名
 
         # 持倉
-        self._positions: List[Dict[str, Any]] = []
+        self._positions: List[_PositionRec] = []  # 最近一次完整的持倉
+        self._positions_buf: List[_PositionRec] = []  # 接收中，positionEnd 時整批換上
+        # SoA 快取：(建立時依據的 _positions list, 欄位陣列)；list 換掉即失效
+        self._positions_arrays: Optional[Tuple[List[_PositionRec], Dict[str, Any]]] = None
         self._positions_completed = threading.Event()
 
         # 維持原行為：啟動即要求 delayed data 類型（3）
@@ -108,6 +247,7 @@ class IBApp(EWrapper, EClient):
     # -------------- 握手完成 --------------
     def nextValidId(self, oid: int):
         # 維持既有行為：更新 req_id、設 ready
+        # （reqIds() 的回覆也會走到這裡，可能與取號並行，故與 _next_rid 共用 _id_lock）
         with self._id_lock:
             if oid > self.req_id:
                 self.req_id = oid
@@ -130,170 +270,201 @@ class IBApp(EWrapper, EClient):
 
     # -------------- 合約細節回調 --------------
     def contractDetails(self, reqId: int, details: ContractDetails):
-        self.contract_details.append(details)
-        self.contract_details_queue.append(details)
+        waiter = self._cd_waiters.get(reqId)
+        if waiter is not None:
+            waiter[1].append(details)
 
     def contractDetailsEnd(self, reqId):
-        self.contract_details_available.set()
+        waiter = self._cd_waiters.pop(reqId, None)
+        if waiter is not None:
+            waiter[0].set()
 
     # -------------- 伺服器時間回調 --------------
     def currentTime(self, server_time):
-        self.current_time_queue.append(server_time)
-        self.current_time_available.set()
+        self._current_time_q.put(server_time)
 
     # -------------- 歷史資料回調 --------------
     def historicalData(self, reqId, bar: BarData):
-        self.historical_data_queue.append(bar)
+        if reqId in self._last_bar_only:
+            self._last_bar_only[reqId] = bar
 
     def historicalDataEnd(self, reqId, start, end):
-        self.historical_data_available.set()
-        self.historical_data_end_available.set()
+        ev = self._hist_end_events.pop(reqId, None)
+        if ev is not None:
+            ev.set()
 
     # -------------- Streaming market-data --------------
     def subscribe(self, con: Contract, is_opt: bool, key: str) -> int:
         """長駐訂閱一檔合約，最新值會寫入 _stream_data[key]"""
         rid = self._next_rid()
         tick_list = TICK_LIST_OPT if is_opt else ""
+        # tickers[rid] 是回調執行緒的工作列，tick 只寫它並標記 dirty；
+        # 發佈執行緒被 tick 喚醒後，等 STREAM_FLUSH_SEC 合併同期 tick，再把 dirty 列
+        # 整列複製、包成唯讀 MappingProxyType，以單一 dict 賦值換上 _stream_data[key]
+        self.tickers[rid] = dict(self._stream_data.get(key, _EMPTY))
         self._stream_key_map[rid] = key
+        if self._stream_flusher is None:
+            self._stream_flusher = threading.Thread(
+                target=self._stream_flush_loop, name="stream-flush", daemon=True
+            )
+            self._stream_flusher.start()
         self.reqMktData(rid, con, tick_list, False, False, [])
         return rid
 
     def unsubscribe(self, rid: int):
-        if rid in self._stream_key_map:
+        with self._stream_lock:
+            key = self._stream_key_map.pop(rid, None)
+            if key is not None:
+                self._stream_data.pop(key, None)
+        if key is not None:
             self.cancelMktData(rid)
-            key = self._stream_key_map.pop(rid)
-            self._stream_data.pop(key, None)
-
-    def get_stream_data(self, key: str) -> Dict[str, Any]:
-        return self._stream_data.get(key, {})
+            self.tickers.pop(rid, None)
+            self._close_events.pop(key, None)
+
+    def get_stream_data(self, key: str) -> Mapping[str, Any]:
+        """最新唯讀快照（最多落後 STREAM_FLUSH_SEC；回傳後不會再被改動，免複製即可安全迭代）"""
+        return self._stream_data.get(key, _EMPTY)
+
+    def wait_for_close(self, key: str, timeout: float) -> Optional[float]:
+        """等訂閱 key 的昨收（prev_close，退而取 close）發佈；逾時回傳 None"""
+        # 先登記事件再檢查，避免檢查後、登記前剛好發佈而白等到逾時
+        ev = self._close_events.setdefault(key, threading.Event())
+        data = self._stream_data.get(key, _EMPTY)
+        close = data.get("prev_close") or data.get("close")
+        if not close and ev.wait(timeout):
+            data = self._stream_data.get(key, _EMPTY)
+            close = data.get("prev_close") or data.get("close")
+        return close or None
+
+    def get_stream_data_many(
+        self, keys: Iterable[str]
+    ) -> Dict[str, Mapping[str, Any]]:
+        """一次取多檔快照；先整表複製一次，各 key 取自同一發佈時點"""
+        published = self._stream_data.copy()
+        return {k: published.get(k, _EMPTY) for k in keys}
+
+    def _flush_stream(self) -> None:
+        # set.pop() 為原子操作：回調執行緒同時加入的 reqId 不會遺失，頂多留到下一輪
+        dirty = self._stream_dirty
+        now = time.monotonic()
+        while dirty:
+            try:
+                rid = dirty.pop()
+            except KeyError:
+                break
+            key = self._stream_key_map.get(rid)
+            row = self.tickers.get(rid)
+            if key is not None and row is not None:
+                snap = row.copy()
+                snap["_ts"] = now  # 發佈時間（monotonic），讀者可據以判斷是否有新行情
+                with self._stream_lock:
+                    # 複製期間可能已被 unsubscribe：不再寫回，免得留下舊快照被下次 subscribe 沿用
+                    if self._stream_key_map.get(rid) != key:
+                        continue
+                    self._stream_data[key] = MappingProxyType(snap)
+                ev = self._close_events.get(key)
+                if ev is not None and (row.get("prev_close") or row.get("close")):
+                    ev.set()
+
+    def _mark_dirty(self, reqId: int) -> None:
+        """長駐訂閱的列有新 tick：排入待發佈並喚醒發佈執行緒（snapshot 列不發佈）"""
+        if reqId in self._stream_key_map:
+            self._stream_dirty.add(reqId)
+            self._stream_wake.set()
+
+    def _stream_flush_loop(self) -> None:
+        # 無 tick（休市、斷線、已全數取消訂閱）時阻塞在 wait，不會每 10ms 空轉
+        wake = self._stream_wake
+        while True:
+            wake.wait()
+            wake.clear()  # 先清再發佈：之後才到的 tick 會再 set，下一輪處理
+            time.sleep(STREAM_FLUSH_SEC)
+            try:
+                self._flush_stream()
+            except Exception:
+                # 單輪失敗不可讓執行緒結束，否則所有讀者從此只看到凍結的快照
+                log.exception("發佈行情快照失敗，執行緒繼續等待後續 tick")
 
     # ---- Tick handlers（維持原始鍵值結構與行為）----
     def tickPrice(self, reqId, field, price, _):
-        if field in (1, 2, 4, 6, 7, 9, 14, 37, 66, 67, 68, 72, 73, 75, 76):
-            if price is None or price < 0:
+        if field < _TICK_TABLE_SIZE:
+            if _PRICE_VALIDATE[field] and (price is None or price < 0):
                 return
-        key = self.FIELD_MAP.get(field, f"p{field}")
-        self.tickers.setdefault(reqId, {})[key] = price
-        if reqId in self._stream_key_map:
-            k = self._stream_key_map[reqId]
-            self._stream_data.setdefault(k, {})[key] = price
+            key = _PRICE_KEYS[field]
+        else:
+            key = f"p{field}"
+        row = self.tickers.get(reqId)
+        if row is None:  # 已取消的訂閱／snapshot 遲到的 tick：不再重建列
+            return
+        row[key] = price
+        self._mark_dirty(reqId)
+        waiter = self._snapshot_waiters.get(reqId)
+        if waiter is not None and _snapshot_ready(row, waiter[1]):
+            waiter[0].set()
 
     def tickSize(self, reqId, field, size):
-        self.tickers.setdefault(reqId, {})[f"size_{field}"] = size
-        if reqId in self._stream_key_map:
-            k = self._stream_key_map[reqId]
-            self._stream_data.setdefault(k, {})[f"size_{field}"] = size
+        key = _SIZE_KEYS[field] if field < _TICK_TABLE_SIZE else f"size_{field}"
+        row = self.tickers.get(reqId)
+        if row is None:  # 已取消的訂閱／snapshot 遲到的 tick：不再重建列
+            return
+        row[key] = size
+        self._mark_dirty(reqId)
 
     def tickGeneric(self, reqId, field, value):
-        self.tickers.setdefault(reqId, {})[f"g{field}"] = value
-        if reqId in self._stream_key_map:
-            k = self._stream_key_map[reqId]
-            self._stream_data.setdefault(k, {})[f"g{field}"] = value
+        key = _GENERIC_KEYS[field] if field < _TICK_TABLE_SIZE else f"g{field}"
+        row = self.tickers.get(reqId)
+        if row is None:  # 已取消的訂閱／snapshot 遲到的 tick：不再重建列
+            return
+        row[key] = value
+        self._mark_dirty(reqId)
 
     def tickOptionComputation(self, reqId, *args):
         # ---- 解析 API 參數（Python 原生 API 9.7+ 的順序）----
         # reqId, field, tickAttrib, iv, delta, optPrice, pvDiv, gamma, vega, theta, undPx
-        field = args[0] if len(args) > 0 else None
-        # tickAttrib = args[1]  # 如需可用，但目前不影響你邏輯
-        iv = args[2] if len(args) > 2 else None
-        delta = args[3] if len(args) > 3 else None
-        gamma = args[6] if len(args) > 6 else None
-        vega = args[7] if len(args) > 7 else None
-        theta = args[8] if len(args) > 8 else None
-        undPx = args[9] if len(args) > 9 else None
-
-        # ---- 將 -1 / 非數值 視為「無效」不覆蓋舊值 ----
-        def _clean(x):
-            if x is None:
-                return None
-            if isinstance(x, (int, float)):
-                if x == -1 or not math.isfinite(x):
-                    return None
-            return x
-
-        iv = _clean(iv)
-        delta = _clean(delta)
-        gamma = _clean(gamma)
-        vega = _clean(vega)
-        theta = _clean(theta)
-        undPx = _clean(undPx)
-
-        # ---- live 與 delayed 的 tickType 合併（10-13 與 80-83）----
-        # 10/11/12/13 = Bid/Ask/Last/Model Option Computation（即時）
-        # 80/81/82/83 = Delayed Bid/Ask/Last/Model Option Computation（延遲）
-        # 官方 tick types 對照表：66–76（延遲價量）與 80–83（延遲 Greeks）。:contentReference[oaicite:0]{index=0}
-        side = {
-            10: "bid",
-            11: "ask",
-            12: "last",
-            13: "model",
-            80: "bid",
-            81: "ask",
-            82: "last",
-            83: "model",
-        }.get(field)
-
-        # ---- 只在新值有效時才覆蓋，避免被 -1 蓋掉 ----
-        bucket = self.tickers.setdefault(reqId, {})
-        if iv is not None:
-            bucket["iv"] = iv
-        if delta is not None:
-            bucket["delta"] = delta
-        if gamma is not None:
-            bucket["gamma"] = gamma
-        if vega is not None:
-            bucket["vega"] = vega
-        if theta is not None:
-            bucket["theta"] = theta
-        if undPx is not None:
-            bucket["undPx"] = undPx
-
-        # （可選）保留 side 明細，若你之後要比較 bid/ask/last 計算版本
-        if side:
-            if iv is not None:
-                bucket[f"{side}_iv"] = iv
-            if delta is not None:
-                bucket[f"{side}_delta"] = delta
-            if gamma is not None:
-                bucket[f"{side}_gamma"] = gamma
-            if vega is not None:
-                bucket[f"{side}_vega"] = vega
-            if theta is not None:
-                bucket[f"{side}_theta"] = theta
-
-        # ---- 同步到 stream 快取（維持你原本行為）----
-        if reqId in self._stream_key_map:
-            k = self._stream_key_map[reqId]
-            out = self._stream_data.setdefault(k, {})
-            for key in ("iv", "delta", "gamma", "vega", "theta", "undPx"):
-                if key in bucket:
-                    out[key] = bucket[key]
-            if side:
-                for key in (
-                    f"{side}_iv",
-                    f"{side}_delta",
-                    f"{side}_gamma",
-                    f"{side}_vega",
-                    f"{side}_theta",
-                ):
-                    if key in bucket:
-                        out[key] = bucket[key]
+        # live 與 delayed 的 tickType 合併（10-13 與 80-83），見 _GREEK_PLANS
+        n = len(args)
+        plan = _GREEK_PLANS.get(args[0], _GREEK_PLAN) if n else _GREEK_PLAN
+
+        bucket = self.tickers.get(reqId)
+        if bucket is None:
+            return
+
+        # ---- 只在新值有效時才覆蓋，避免被 -1 / 非數值蓋掉 ----
+        # 先收進 upd 再一次 update：發佈執行緒複製時不會看到半筆 greeks
+        isfinite = math.isfinite
+        upd = {}
+        for key, idx, side_key in plan:
+            if idx >= n:
+                break  # idx 遞增，後面的也不會有
+            v = args[idx]
+            if v is None or v == -1 or not isfinite(v):
+                continue
+            upd[key] = v
+            # （可選）保留 side 明細（undPx 不分 side）
+            if side_key is not None:
+                upd[side_key] = v
+        bucket.update(upd)
+
+        self._mark_dirty(reqId)
+
+        waiter = self._snapshot_waiters.get(reqId)
+        if waiter is not None and _snapshot_ready(bucket, waiter[1]):
+            waiter[0].set()
 
     # -------------- 單檔 Snapshot（行為不變）--------------
     def snapshot(self, con: Contract, is_opt: bool) -> Dict[str, Any]:
         rid = self._next_rid()
         tick_list = TICK_LIST_OPT if is_opt else ""
-        self.reqMktData(rid, con, tick_list, False, False, [])
-        t0 = time.monotonic()
-        while time.monotonic() - t0 < TIMEOUT:
-            d = self.tickers.get(rid, {})
-            price_ready = any(k in d for k in ("last", "bid", "ask"))
-            greeks_ready = (not is_opt) or ("delta" in d and d["delta"] is not None)
-            if price_ready and greeks_ready:
-                break
-            time.sleep(0.05)
-        self.cancelMktData(rid)
-        data = self.tickers.pop(rid, {})
+        self.tickers[rid] = {}
+        ready = threading.Event()
+        self._snapshot_waiters[rid] = (ready, is_opt)
+        try:
+            self.reqMktData(rid, con, tick_list, False, False, [])
+            ready.wait(TIMEOUT)
+            self.cancelMktData(rid)
+        finally:
+            self._snapshot_waiters.pop(rid, None)
+            data = self.tickers.pop(rid, {})
         if DEBUG:
             print("DEBUG tick", con.symbol, con.right if is_opt else "STK", data)
         price = data.get("last") or data.get("bid") or data.get("ask")
@@ -311,101 +482,155 @@ class IBApp(EWrapper, EClient):
         d = et_now + datetime.timedelta(days=1)
         while d.weekday() >= 5:
             d += datetime.timedelta(days=1)
-        next_open = tz.localize(datetime.datetime(d.year, d.month, d.day, 9, 30))
+        next_open = datetime.datetime.combine(d.date(), _RTH_OPEN, tzinfo=tz)
         self.market_status["next_open"] = next_open
 
     def is_regular_market_open(self) -> bool:
-        server_time = self.get_server_time()
-        if not server_time:
-            return self.market_status.get("is_open", True)
-        et = server_time.astimezone(self.us_eastern)
+        # 連線正常且最近取過伺服器時間：以 monotonic 外推，不再往返 IB
+        et = self._extrapolated_server_time()
+        if et is None:
+            server_time = self.get_server_time()
+            if not server_time:
+                return self.market_status.get("is_open", True)
+            et = server_time.astimezone(self.us_eastern)
         if et.weekday() >= 5:
             return False
-        t = et.time()
-        return datetime.time(9, 30) <= t < datetime.time(16, 0)
+        sod = et.hour * 3600 + et.minute * 60 + et.second
+        return _RTH_OPEN_SEC <= sod < _RTH_CLOSE_SEC
+
+    def _extrapolated_server_time(
+        self, max_age: float = SERVER_TIME_EXTRAPOLATE_SEC
+    ) -> Optional[datetime.datetime]:
+        """上次取得的伺服器時間 + monotonic 經過秒數；過舊或已斷線回傳 None"""
+        last = self._last_server_time
+        if last is None or not self.isConnected():
+            return None
+        age = time.monotonic() - self._server_time_ts
+        if age >= max_age:
+            return None
+        # 以 UTC 相加（經過秒數），回傳前才轉 ET；直接對 ET 加會按牆上時間算，跨夏令時間差一小時
+        return (last + datetime.timedelta(seconds=age)).astimezone(self.us_eastern)
+
+    _stk_contracts: Dict[str, Contract] = {}  # symbol -> SMART/USD 股票合約（唯讀共用）
+
+    @classmethod
+    def _stk_contract(cls, symbol: str) -> Contract:
+        con = cls._stk_contracts.get(symbol)
+        if con is None:
+            con = Contract()
+            con.symbol = symbol
+            con.secType = "STK"
+            con.exchange = "SMART"
+            con.currency = "USD"
+            cls._stk_contracts[symbol] = con
+        return con
 
     _last_server_time: Optional[datetime.datetime] = None
     _server_time_ts: float = 0.0  # monotonic 秒
     _server_time_extrapolate_max = 6 * 3600  # 允許外推的最長秒數（例如 6 小時）
+    _market_check_ts: float = float("-inf")  # is_market_open 上次實查的 monotonic 秒
 
     def get_server_time(
         self,
         retry: int = 3,
-        timeout: float = 5.0,
+        timeout: float = 1.5,
         extrapolate: bool = True,
         soft_cache_age: float = 90.0,
         hard_cache_age: Optional[float] = None,
     ) -> Optional[datetime.datetime]:
         """
         取得伺服器時間：
-        - 嘗試 N 次；成功則更新 _last_server_time 與 _server_time_ts。
+        - 嘗試 N 次（每次最多等 timeout 秒，重試間 0.1s 起指數退避，總長不超過 retry*timeout）；
+          成功則更新 _last_server_time 與 _server_time_ts。
         - 失敗時：
           a) 若距上次成功 < soft_cache_age（預設 90s），直接回舊值；
           b) 若 extrapolate=True 且距上次成功 < _server_time_extrapolate_max，用 monotonic 外推；
           c) 若指定 hard_cache_age 且未超過，也可回舊值（可當額外保險）。
         """
-        for _ in range(retry):
-            self.current_time_available.clear()
-            self.current_time_queue.clear()
+        deadline = time.monotonic() + retry * timeout
+        for attempt in range(retry):
+            if attempt:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(0.1 * 2 ** (attempt - 1), remaining))
+            # 每次等待不超過剩餘總預算（退避的 sleep 也算在內）
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # 丟掉先前逾時後才到的舊回覆
+            try:
+                while True:
+                    self._current_time_q.get_nowait()
+            except queue.Empty:
+                pass
             self.reqCurrentTime()
-            if self.current_time_available.wait(timeout):
-                ts = self.current_time_queue.popleft()
-                dt = datetime.datetime.fromtimestamp(ts, tz=pytz.UTC)
-                self._last_server_time = dt
-                self._server_time_ts = time.monotonic()
-                return dt
-            time.sleep(0.2)
+            try:
+                ts = self._current_time_q.get(timeout=min(timeout, remaining))
+            except queue.Empty:
+                continue
+            # 以 UTC 保存（外推相加才是真實經過時間），回傳時轉成 ET：
+            # 呼叫端的 astimezone(us_eastern) 遇同一 tzinfo 會原樣返回
+            self._last_server_time = datetime.datetime.fromtimestamp(
+                ts, tz=datetime.timezone.utc
+            )
+            self._server_time_ts = time.monotonic()
+            return self._last_server_time.astimezone(self.us_eastern)
 
         if self._last_server_time:
             age = time.monotonic() - self._server_time_ts
             # a) 短期快取：直接回舊值
             if age < soft_cache_age:
-                return self._last_server_time
-            # b) 外推（關鍵修補）：用單調時鐘推進伺服器時間
+                return self._last_server_time.astimezone(self.us_eastern)
+            # b) 外推（關鍵修補）：用單調時鐘推進伺服器時間（UTC 相加後再轉 ET）
             if extrapolate and age < self._server_time_extrapolate_max:
-                return self._last_server_time + datetime.timedelta(seconds=age)
+                return (
+                    self._last_server_time + datetime.timedelta(seconds=age)
+                ).astimezone(self.us_eastern)
             # c) 可選：硬快取上限
             if hard_cache_age is not None and age < hard_cache_age:
-                return self._last_server_time
+                return self._last_server_time.astimezone(self.us_eastern)
 
         return None
     
     def check_recent_trades(self, symbol: str = "SPY") -> bool:
-        self.historical_data_available.clear()
-        self.historical_data_end_available.clear()
-        self.historical_data_queue.clear()
-
-        contract = Contract()
-        contract.symbol = symbol
-        contract.secType = "STK"
-        contract.exchange = "SMART"
-        contract.currency = "USD"
+        contract = self._stk_contract(symbol)
 
         req_id = self._next_rid()
         end_time = ""
         duration = "300 S"
         bar_size = "1 min"
-        self.reqHistoricalData(
-            req_id, contract, end_time, duration, bar_size, "TRADES", 1, 1, False, []
-        )
+        done = threading.Event()
+        self._last_bar_only[req_id] = None
+        self._hist_end_events[req_id] = done
+        try:
+            self.reqHistoricalData(
+                req_id, contract, end_time, duration, bar_size,
+                "TRADES", 1, 1, False, [],
+            )
+            if not done.wait(10):
+                return False
+        finally:
+            self._hist_end_events.pop(req_id, None)
+            recent_bar = self._last_bar_only.pop(req_id, None)
+        return recent_bar is not None and recent_bar.volume > 0
 
-        if not self.historical_data_end_available.wait(10):
-            return False
-        if not self.historical_data_queue:
-            return False
+    def is_market_open(self) -> Dict[str, Any]:
+        # 節流以 monotonic 計時（不受 NTP 校時跳動影響）；last_check 僅供顯示
+        mono = time.monotonic()
+        if mono - self._market_check_ts < 60:
+            return self.market_status
 
-        recent_bar = self.historical_data_queue[-1]
-        return recent_bar.volume > 0
+        self._market_check_ts = mono
+        self.market_status["last_check"] = datetime.datetime.now()
 
-    def is_market_open(self) -> Dict[str, Any]:
-        now = datetime.datetime.now()
-        if (
-            self.market_status["last_check"]
-            and (now - self.market_status["last_check"]).total_seconds() < 60
-        ):
+        # 週末以本機時鐘判斷即可，不必向 IB 要伺服器時間
+        et_local = datetime.datetime.now(self.us_eastern)
+        if et_local.weekday() >= 5:
+            self.market_status["is_open"] = False
+            self._calculate_next_trading_day(et_local)
             return self.market_status
 
-        self.market_status["last_check"] = now
         server_time = self.get_server_time(extrapolate=True, soft_cache_age=90.0)
 
         # 允許短期失聯時維持開市（sticky-open）
@@ -415,7 +640,7 @@ class IBApp(EWrapper, EClient):
         if not server_time:
             if was_open:
                 # 若上一狀態為開市，且距離上次成功取時不超過 STICKY_GRACE，維持開市
-                age = time.monotonic() - self._server_time_ts if self._server_time_ts else 1e9
+                age = mono - self._server_time_ts if self._server_time_ts else 1e9
                 if age < STICKY_GRACE:
                     log.warning("無法獲取伺服器時間 - sticky-open 生效，暫時視為仍在交易")
                     return self.market_status
@@ -436,13 +661,7 @@ class IBApp(EWrapper, EClient):
             return self.market_status
 
         # 優先用 SPY 的交易時間（快取/查詢）
-        spy_contract = Contract()
-        spy_contract.symbol = "SPY"
-        spy_contract.secType = "STK"
-        spy_contract.exchange = "SMART"
-        spy_contract.currency = "USD"
-
-        trading_hours = self.get_contract_trading_hours(spy_contract)
+        trading_hours = self.get_contract_trading_hours(self._stk_contract("SPY"))
         if not trading_hours:
             log.warning("無法獲取交易時間信息，改用最近成交偵測")
             has_recent_trades = self.check_recent_trades()
@@ -456,7 +675,7 @@ class IBApp(EWrapper, EClient):
         # 黏著邏輯：若剛好在一般收盤臨界（例如 16:00 附近）避免抖動
         if was_open and not is_open_now:
             # 收盤後 5 分鐘內，仍用「有無成交」確認一次，避免誤判
-            if et_time.time() <= datetime.time(16, 5):
+            if et_time.time() <= _RTH_CLOSE_GRACE:
                 if self.check_recent_trades():
                     is_open_now = True
 
@@ -465,47 +684,48 @@ class IBApp(EWrapper, EClient):
             self._calculate_next_trading_day(et_time)
         return self.market_status
 
+    def warmup_trading_calendar(self, symbol: str = "SPY") -> bool:
+        """
+        連線後預取 tradingHours 並先解析今日區段；之後 is_market_open 命中快取、
+        只剩本地比較。需在回調執行緒之外呼叫（會等待 contractDetailsEnd）。
+        """
+        trading_hours = self.get_contract_trading_hours(self._stk_contract(symbol))
+        if not trading_hours:
+            log.warning("預取 %s 交易時間失敗，將於檢查市場狀態時再查", symbol)
+            return False
+        today = datetime.datetime.now(self.us_eastern).strftime("%Y%m%d")
+        _todays_trading_windows(trading_hours, today, self.us_eastern)
+        return True
+
     def get_contract_trading_hours(self, contract: Contract) -> Optional[str]:
-        self.contract_details_available.clear()
-        self.contract_details_queue.clear()
-        rid = self._next_rid()
-        self.reqContractDetails(rid, contract)
-        if not self.contract_details_available.wait(10):
-            return None
-        if not self.contract_details_queue:
+        # 以 conId 區分合約（同代號的 STK/OPT 交易時間不同）；無 conId 時退回 (symbol, secType)
+        # 日期取 ET 交易日，換日時機與交易時段一致，而非主機本地日期
+        today = datetime.datetime.now(self.us_eastern).date()
+        cache_key = (contract.conId or (contract.symbol, contract.secType), today)
+        cached = self._th_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < TRADING_HOURS_TTL:
+            return cached[1]
+
+        details = self._request_contract_details(contract, 10)
+        if not details:
             return None
-        details = self.contract_details_queue[0]
-        return details.tradingHours
+        trading_hours = details[0].tradingHours
+        if trading_hours:
+            cache = self._th_cache
+            # 順手清掉前幾個交易日的項目，快取大小不隨天數成長
+            for stale in [k for k in cache if k[1] != today]:
+                del cache[stale]
+            cache[cache_key] = (time.monotonic(), trading_hours)
+        return trading_hours
 
     def _parse_trading_hours(
         self, trading_hours: str, current_time: datetime.datetime
     ) -> bool:
-        def _split_ranges(s: str):
-            for seg in s.split(";"):
-                for rng in seg.split(","):
-                    yield rng.strip()
-
-        _RANGE_RE = re.compile(
-            r"^(?P<sdate>\d{8}):(?P<stime>\d{4})-(?:(?P<edate>\d{8}):)?(?P<etime>\d{4})$"
-        )
-        today = current_time.strftime("%Y%m%d")
         tz = self.us_eastern
-
-        for rng in _split_ranges(trading_hours):
-            if rng.endswith("CLOSED"):
-                continue
-            m = _RANGE_RE.match(rng)
-            if not m or m["sdate"] != today:
-                continue
-            start_dt = tz.localize(
-                datetime.datetime.strptime(m["sdate"] + m["stime"], "%Y%m%d%H%M")
-            )
-            end_dt = tz.localize(
-                datetime.datetime.strptime(
-                    (m["edate"] or m["sdate"]) + m["etime"], "%Y%m%d%H%M"
-                )
-            )
-            if start_dt <= current_time < end_dt:
+        today = current_time.astimezone(tz).strftime("%Y%m%d")
+        now = current_time.timestamp()
+        for start, end in _todays_trading_windows(trading_hours, today, tz):
+            if start <= now < end:
                 return True
         return False
 
@@ -514,50 +734,74 @@ class IBApp(EWrapper, EClient):
         if not self.isConnected():
             log.warning("無法請求艙位數據 - 未連接")
             return False
-        self._positions = []
+        self._positions_buf = []
         self._positions_completed.clear()
         super().reqPositions()
         return True
 
     def position(self, account: str, contract: Contract, pos: float, avgCost: float):
-        self._positions.append(
-            {
-                "account": account,
-                "conId": contract.conId,
-                "secType": contract.secType,
-                "symbol": contract.symbol,
-                "lastTradeDateOrContractMonth": contract.lastTradeDateOrContractMonth,
-                "strike": contract.strike,
-                "right": contract.right,
-                "exchange": contract.exchange,
-                "currency": contract.currency,
-                "position": pos,
-                "avgCost": avgCost,
-                "tradingClass": contract.tradingClass,
-                "multiplier": contract.multiplier,
-            }
-        )
+        rec = _PositionRec(account, contract, pos, avgCost)
+        if not self._positions_completed.is_set():
+            self._positions_buf.append(rec)
+        else:
+            # positionEnd 之後的即時更新（reqPositions 是訂閱）：
+            # 依 (account, conId) 在副本上更新後整批換上，已交出的 list 不會被改動
+            recs = list(self._positions)
+            for i, old in enumerate(recs):
+                if old.conId == rec.conId and old.account == account:
+                    recs[i] = rec
+                    break
+            else:
+                recs.append(rec)
+            self._positions = recs
         log.debug(f"收到艙位更新: {contract.symbol} {pos}")
 
     def positionEnd(self):
+        self._positions = self._positions_buf
+        self._positions_buf = []  # 換上後另起新緩衝，避免與 _positions 共用同一 list
         log.info(f"艙位數據接收完畢，共 {len(self._positions)} 筆")
         self._positions_completed.set()
 
     def getPositions(
         self, timeout: float = 10.0, refresh: bool = True
-    ) -> List[Dict[str, Any]]:
+    ) -> List[_PositionRec]:
         if not self.isConnected():
             log.warning("無法獲取艙位數據 - 未連接")
             return []
         if refresh:
-            self._positions = []
+            self._positions_buf = []
             self._positions_completed.clear()
             super().reqPositions()
             self._positions_completed.wait(timeout)
             if not self._positions_completed.is_set():
                 log.warning(f"獲取艙位數據超時 ({timeout}秒)")
+                return list(self._positions_buf)
         return self._positions
 
+    def getPositionsAsArrays(self) -> Dict[str, Any]:
+        """
+        最近一次完整持倉的欄位陣列（欄位名 -> numpy.ndarray，與 getPositions 同序），
+        每份 _positions 首次呼叫時建立並快取，供向量化彙總使用。
+        """
+        if not _HAS_NUMPY:
+            raise RuntimeError("numpy 未安裝，無法提供陣列格式持倉")
+        # _positions 換上後不再被改動：快取綁定 list 本身，
+        # positionEnd 或之後的單筆更新換上新 list 時自然失效
+        recs = self._positions
+        cached = self._positions_arrays
+        if cached is not None and cached[0] is recs:
+            arrays = cached[1]
+        else:
+            arrays = {
+                name: np.array(
+                    [getattr(r, name) for r in recs],
+                    dtype=_POSITION_DTYPES.get(name, object),
+                )
+                for name in _PositionRec.__slots__
+            }
+            self._positions_arrays = (recs, arrays)
+        return arrays
+
     def cancelPositions(self):
         if not self.isConnected():
             log.warning("無法取消艙位訂閱 - 未連接")
@@ -566,11 +810,58 @@ class IBApp(EWrapper, EClient):
         return True
 
     # -------------- Contract details（同步封裝，行為等價）--------------
-    def req_contract_details_blocking(self, contract: Contract, timeout: float = 5.0):
-        self.contract_details.clear()
+    def req_contract_details_blocking(
+        self, contract: Contract, timeout: float = 5.0
+    ) -> List[ContractDetails]:
+        details = self._request_contract_details(contract, timeout)
+        return details if details is not None else []
+
+    def _request_contract_details(
+        self, contract: Contract, timeout: float
+    ) -> Optional[List[ContractDetails]]:
+        """送出 reqContractDetails 並等該 reqId 的 End；逾時回傳 None"""
         rid = self._next_rid()
-        self.reqContractDetails(rid, contract)
-        t0 = time.monotonic()
-        while time.monotonic() - t0 < timeout and not self.contract_details:
-            time.sleep(0.05)
-        return self.contract_details
+        ready = threading.Event()
+        buf: List[ContractDetails] = []
+        self._cd_waiters[rid] = (ready, buf)
+        try:
+            self.reqContractDetails(rid, contract)
+            if not ready.wait(timeout):
+                return None
+        finally:
+            self._cd_waiters.pop(rid, None)
+        return buf
+
+
+# -------------- Greeks 欄位（tickOptionComputation 用）--------------
+_GREEK_KEYS = ("iv", "delta", "gamma", "vega", "theta", "undPx")
+_GREEK_ARG_IDX = (2, 3, 6, 7, 8, 9)  # 對應 args 的位置（不含 reqId）
+# 每個 tickType 預先展開成 (key, args 位置, side key) 三元組，回調內只需迭代
+_GREEK_PLAN = tuple((k, i, None) for k, i in zip(_GREEK_KEYS, _GREEK_ARG_IDX))
+# 10/11/12/13 = Bid/Ask/Last/Model Option Computation（即時）
+# 80/81/82/83 = Delayed Bid/Ask/Last/Model Option Computation（延遲）
+_GREEK_PLANS = {
+    field: tuple(
+        (k, i, f"{side}_{k}" if k != "undPx" else None)
+        for k, i in zip(_GREEK_KEYS, _GREEK_ARG_IDX)
+    )
+    for side, fields in (
+        ("bid", (10, 80)),
+        ("ask", (11, 81)),
+        ("last", (12, 82)),
+        ("model", (13, 83)),
+    )
+    for field in fields
+}
+
+# -------------- tick 欄位名稱查表（以 field id 直接索引，免雜湊與字串格式化）--------------
+_PRICE_KEYS = tuple(
+    IBApp.FIELD_MAP.get(i) or sys.intern(f"p{i}") for i in range(_TICK_TABLE_SIZE)
+)
+_SIZE_KEYS = tuple(sys.intern(f"size_{i}") for i in range(_TICK_TABLE_SIZE))
+_GENERIC_KEYS = tuple(sys.intern(f"g{i}") for i in range(_TICK_TABLE_SIZE))
+# 需過濾負值 / None 的價格欄位（bid/ask/last/high/low/close/open/mark 及其延遲版）
+_PRICE_VALIDATE = bytearray(_TICK_TABLE_SIZE)
+for _f in (1, 2, 4, 6, 7, 9, 14, 37, 66, 67, 68, 72, 73, 75, 76):
+    _PRICE_VALIDATE[_f] = 1
+del _f
@@ -1,16 +1,22 @@
 from __future__ import annotations
 
+import atexit
 import datetime
+import functools
 import logging
 import os
+import queue
+import threading
 import time
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from logging.handlers import RotatingFileHandler
-from typing import Dict, Optional
+from typing import Any, Dict, Mapping, Optional, Sequence
 
-import pytz
 import requests
 from ibapi.contract import Contract
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from IBApp import IBApp
 
@@ -25,14 +31,22 @@ def configure_logging(
     console.setLevel(numeric)
 
     class DedupFilter(logging.Filter):
-        _cache: dict[str, float] = {}
+        # 訊息 -> 上次放行時間；依最近使用排序，超過上限淘汰最舊的
+        _cache: "OrderedDict[str, float]" = OrderedDict()
+        _MAX = 4096
 
         def filter(self, record: logging.LogRecord) -> bool:  # noqa: N802
+            if record.levelno < logging.INFO:
+                return True  # DEBUG 不去重，也不必格式化訊息
             msg, now = record.getMessage(), record.created
-            last = self._cache.get(msg, 0.0)
+            cache = self._cache
+            last = cache.get(msg, 0.0)
             if now - last < 30:
                 return False
-            self._cache[msg] = now
+            cache[msg] = now
+            cache.move_to_end(msg)
+            if len(cache) > self._MAX:
+                cache.popitem(last=False)
             return True
 
     console.addFilter(DedupFilter())
@@ -72,24 +86,90 @@ _TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "") or (
 )
 _LINE_EP = "https://api.line.me/v2/bot/message/broadcast"
 _HEADERS = {"Authorization": f"Bearer {_TOKEN}", "Content-Type": "application/json"}
+_LINE_MAX_MESSAGES = 5  # broadcast 單次最多 5 則
 CHECK_INTERVAL = 60  # 行為不變：每 60 秒檢查一次
+_MARKET_WAIT_MAX_SLEEP = 300  # 等開盤時單次 sleep 上限（秒）
+
+# 共用連線：keep-alive 重用 TLS；只重試連線失敗（請求未送出，不會重複廣播）
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        max_retries=Retry(total=2, read=0, status=0, backoff_factor=0.3),
+    ),
+)
+
+
+# 推播改由背景執行緒送出：主迴圈只負責排入佇列，不被 LINE 回應速度拖住
+_ALERT_Q: "queue.Queue[Sequence[str]]" = queue.Queue(maxsize=256)
+_pusher: Optional[threading.Thread] = None
+_pusher_lock = threading.Lock()
 
 
-def line_push(msg: str) -> None:
+def _post_messages(msgs: Sequence[str]) -> None:
+    for i in range(0, len(msgs), _LINE_MAX_MESSAGES):
+        batch = msgs[i : i + _LINE_MAX_MESSAGES]
+        try:
+            r = _SESSION.post(
+                _LINE_EP,
+                headers=_HEADERS,
+                json={"messages": [{"type": "text", "text": m[:1000]} for m in batch]},
+                timeout=(2, 5),  # (連線, 讀取)：連不上時 2 秒即放棄，不佔滿 5 秒
+            )
+            if r.status_code != 200:
+                log.error("LINE API %s: %s", r.status_code, r.text[:200])
+        except Exception as exc:  # noqa: BLE001
+            log.error("LINE Broadcast 例外: %s", exc)
+
+
+def _pusher_worker() -> None:
+    while True:
+        msgs = _ALERT_Q.get()
+        try:
+            _post_messages(msgs)
+        finally:
+            _ALERT_Q.task_done()
+
+
+def _drain_line_push(timeout: float = 10.0) -> None:
+    """結束前等佇列送完（最多 timeout 秒）再關 Session；逾時未送出的則數記入日誌"""
+    deadline = time.monotonic() + timeout
+    q = _ALERT_Q
+    with q.all_tasks_done:
+        while q.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.error("結束時仍有 %d 批 LINE 推播未送出", q.unfinished_tasks)
+                break
+            q.all_tasks_done.wait(remaining)
+    _SESSION.close()
+
+
+# main.py 收到 SIGTERM 以 sys.exit 結束；背景推播執行緒是 daemon，須在此等它送完
+atexit.register(_drain_line_push)
+
+
+def line_push(msgs: str | Sequence[str]) -> None:
+    """排入一則或多則訊息待廣播（不阻塞）；多則時每 5 則合併成一次 API 呼叫"""
+    global _pusher
+    if isinstance(msgs, str):
+        msgs = (msgs,)
     if not _TOKEN:
         log.warning("未設定 LINE TOKEN，警報僅寫入日誌")
         return
+    if _pusher is None:
+        with _pusher_lock:
+            if _pusher is None:
+                _pusher = threading.Thread(
+                    target=_pusher_worker, name="line-push", daemon=True
+                )
+                _pusher.start()
     try:
-        r = requests.post(
-            _LINE_EP,
-            headers=_HEADERS,
-            json={"messages": [{"type": "text", "text": msg[:1000]}]},
-            timeout=5,
-        )
-        if r.status_code != 200:
-            log.error("LINE API %s: %s", r.status_code, r.text[:200])
-    except Exception as exc:  # noqa: BLE001
-        log.error("LINE Broadcast 例外: %s", exc)
+        _ALERT_Q.put_nowait(tuple(msgs))
+    except queue.Full:
+        log.error("LINE 推播佇列已滿，丟棄 %d 則訊息", len(msgs))
 
 
 # ──────────────────────────── 資料類別 ────────────────────────────
@@ -103,6 +183,10 @@ class StrategyConfig:
     buy_delta_floor: float = 0.65  # 只對 BUY 生效的下限
 
 
+# IB 持倉的 right 縮寫 -> ContractConfig.right 標準寫法
+_RIGHT_FULL = {"P": "PUT", "C": "CALL"}
+
+
 @dataclass(slots=True)
 class ContractConfig:
     symbol: str
@@ -117,6 +201,16 @@ class ContractConfig:
     con_id: int = 0
     trading_class: str = ""
     multiplier: str = "100"
+    # 由 action 推導（__post_init__ 設定），主迴圈免每輪比對字串
+    is_sell: bool = field(default=False, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # 建構時統一成標準寫法，之後各處直接比對 "SELL" / "PUT"
+        # （IB 持倉回調的 right 是 "P"/"C"，一律展開成 "PUT"/"CALL"）
+        self.action = self.action.upper()
+        right = self.right.upper()
+        self.right = _RIGHT_FULL.get(right, right)
+        self.is_sell = self.action == "SELL"
 
     def to_ib(self) -> Contract:
         """
@@ -147,6 +241,21 @@ class ContractConfig:
         return c
 
 
+# 警報文字用的權利別縮寫（ContractConfig.right 已統一為 PUT/CALL）
+_RIGHT_ABBR = {"PUT": "P", "CALL": "C"}
+
+# 週一..週日 → 距下一個平日的天數（_next_regular_open_time 用，不含假日）
+_DAYS_TO_NEXT_WEEKDAY = (1, 1, 1, 1, 3, 2, 1)
+
+_PICK_PRICE_KEYS = ("last", "bid", "ask", "p68", "p66", "p67", "p37")
+
+
+@functools.lru_cache(maxsize=512)
+def _expiry_date(expiry: str) -> datetime.date:
+    """'YYYYMMDD' -> date；每個到期日只解析一次（到期日本身不隨日期變動）"""
+    return datetime.datetime.strptime(expiry, "%Y%m%d").date()
+
+
 # ──────────────────────────── AlertEngine ────────────────────────────
 
 
@@ -157,14 +266,21 @@ class AlertEngine:
 
         # 動態資料
         self.cfgs: Dict[str, ContractConfig] = {}
+        self._underlying_symbols: frozenset[str] = frozenset()  # 隨 cfgs 更新
+        self._cfg_items: tuple[tuple[str, ContractConfig], ...] = ()  # 同上
+        self._stream_keys: tuple[str, ...] = ()  # 主迴圈每輪讀取的 stream key
+        self._subscriptions: Dict[str, int] = {}  # 已訂閱的 stream key -> reqId
+        # stream key -> 上輪已評估快照的發佈時間（_ts）；未變就略過 Δ／收益計算
+        self._last_seen_ts: Dict[str, float] = {}
         self.init_price: Dict[str, float] = {}
         self.prev_closes: Dict[str, float] = {}
-        self.sent_alerts: Dict[str, datetime.date] = {}
+        self.sent_alerts: set[str] = set()  # 當日已發送的警報 id（換日時清空）
 
         self.trading_date = datetime.date.today()
         self.market_closed_notified = False
-        self.last_market_status_check = datetime.datetime.min
-        self.last_positions_update = 0.0
+        # 節流計時一律用 monotonic（不受系統校時影響）
+        self.last_market_status_check = float("-inf")
+        self.last_positions_update = float("-inf")
 
         # 啟動即載入持倉與訂閱行情
         self.refresh_positions(force=True)
@@ -179,10 +295,20 @@ class AlertEngine:
         else:
             log.info("啟動成功，目前期權持倉 %d 檔", len(self.cfgs))
 
+    def _rebuild_indexes(self) -> None:
+        """cfgs 換新後重建衍生索引（主迴圈每輪直接沿用）"""
+        self._underlying_symbols = frozenset(c.symbol for c in self.cfgs.values())
+        self._cfg_items = tuple(self.cfgs.items())
+        self._stream_keys = (*self._underlying_symbols, *self.cfgs)
+
     # ─────────── Streaming helpers ────────────
     def _subscribe_market_data(self) -> None:
-        underlying_symbols = {cfg.symbol for cfg in self.cfgs.values()}
-        for sym in underlying_symbols:
+        """與目前持倉比對：只訂閱新增的標的/期權，取消已不在持倉中的訂閱"""
+        underlying_symbols = self._underlying_symbols
+        subs = self._subscriptions
+        for key in subs.keys() - underlying_symbols - self.cfgs.keys():
+            self.app.unsubscribe(subs.pop(key))
+        for sym in underlying_symbols - subs.keys():
             stk = Contract()
             stk.symbol, stk.secType, stk.exchange, stk.currency = (
                 sym,
@@ -190,9 +316,9 @@ class AlertEngine:
                 "SMART",
                 "USD",
             )
-            self.app.subscribe(stk, False, sym)
-        for key, cfg in self.cfgs.items():
-            self.app.subscribe(cfg.to_ib(), True, key)
+            subs[sym] = self.app.subscribe(stk, False, sym)
+        for key in self.cfgs.keys() - subs.keys():
+            subs[key] = self.app.subscribe(self.cfgs[key].to_ib(), True, key)
         log.info("已訂閱 %d 標的與 %d 期權", len(underlying_symbols), len(self.cfgs))
 
     # ─────────── Positions 載入 ────────────
@@ -226,12 +352,6 @@ class AlertEngine:
         log.info("成功載入 %d 筆合約", len(contracts))
         return contracts
 
-    # ─────────── 工具函式 ────────────
-    @staticmethod
-    def _dte(expiry: str) -> int:
-        expire = datetime.datetime.strptime(expiry, "%Y%m%d").date()
-        return (expire - datetime.date.today()).days
-
     # ─────────── Snapshot ───────────
     def first_snap(self) -> None:
         log.info("獲取首次快照資料 ...")
@@ -242,10 +362,13 @@ class AlertEngine:
             self.init_price[k] = c.premium
             log.debug("%s premium = %.4f", k, c.premium)
 
-        # 昨收（僅 underlying）
+        # 昨收（僅 underlying）；各檔共用同一截止時間，總等待取最大值而非加總
         self.prev_closes.clear()
-        for symbol in {cfg.symbol for cfg in self.cfgs.values()}:
-            prev_close = self._get_underlying_prev_close(symbol)
+        deadline = time.monotonic() + 10.0
+        for symbol in self._underlying_symbols:
+            prev_close = self._get_underlying_prev_close(
+                symbol, max(0.0, deadline - time.monotonic())
+            )
             if prev_close:
                 self.prev_closes[symbol] = prev_close
                 log.debug("%s 昨收 %.2f", symbol, prev_close)
@@ -260,18 +383,18 @@ class AlertEngine:
                 time.sleep(300)
                 continue
 
-            now_et = datetime.datetime.now(pytz.UTC).astimezone(self.app.us_eastern)  # type: ignore[attr-defined]
+            now_et = datetime.datetime.now(self.app.us_eastern)  # type: ignore[attr-defined]
             wait_seconds = (next_open - now_et).total_seconds()
 
-            if wait_seconds <= 60:
-                log.info("市場即將開盤，30 秒後再次確認 ...")
-                time.sleep(30)
-            else:
-                log.info(
-                    "市場尚未開盤，預計開盤時間: %s",
-                    next_open.strftime("%Y-%m-%d %H:%M:%S %Z"),
-                )
-                time.sleep(min(wait_seconds, 300))
+            # 睡到預計開盤時間，但單次最多 5 分鐘，醒來後回到迴圈頂端再向 IB 確認一次。
+            # 上限不可省：開盤檢查與 next_open 各自取伺服器時間，若前者讀到 09:29:59、
+            # 後者讀到 09:30:00，next_open 會算成下一個交易日，沒有上限就會睡掉一整天
+            log.info(
+                "市場尚未開盤，預計開盤時間: %s（約 %.0f 秒後）",
+                next_open.strftime("%Y-%m-%d %H:%M:%S %Z"),
+                max(wait_seconds, 0.0),
+            )
+            time.sleep(min(max(1.0, wait_seconds), _MARKET_WAIT_MAX_SLEEP))
         log.info("市場已開盤 (正規時段)，開始監控")
 
     def _next_regular_open_time(self) -> datetime.datetime:
@@ -279,20 +402,19 @@ class AlertEngine:
         et_now = (
             server_time.astimezone(self.app.us_eastern)  # type: ignore[attr-defined]
             if server_time
-            else datetime.datetime.now(pytz.UTC).astimezone(self.app.us_eastern)  # type: ignore[attr-defined]
+            else datetime.datetime.now(self.app.us_eastern)  # type: ignore[attr-defined]
         )
         today_open = et_now.replace(hour=9, minute=30, second=0, microsecond=0)
-        if et_now.weekday() < 5 and et_now < today_open:
+        weekday = et_now.weekday()
+        if weekday < 5 and et_now < today_open:
             return today_open
-        next_day = et_now + datetime.timedelta(days=1)
-        while next_day.weekday() >= 5:
-            next_day += datetime.timedelta(days=1)
-        return next_day.replace(hour=9, minute=30, second=0, microsecond=0)
+        # ZoneInfo 的 datetime 加減以牆上時間計，跨夏令時間仍為 09:30
+        return today_open + datetime.timedelta(days=_DAYS_TO_NEXT_WEEKDAY[weekday])
 
     # ─────────── 市場狀態 ────────────
-    def _check_market_status(self) -> bool:
-        now = datetime.datetime.now()
-        if (now - self.last_market_status_check).total_seconds() < 300:
+    def _check_market_status(self, today: datetime.date | None = None) -> bool:
+        now = time.monotonic()
+        if now - self.last_market_status_check < 300:
             return self.app.market_status["is_open"]  # type: ignore[attr-defined]
 
         self.last_market_status_check = now
@@ -304,10 +426,11 @@ class AlertEngine:
             market_status["next_open"] = self._next_regular_open_time()
 
         if market_status["is_open"]:
-            current_date = datetime.datetime.now().date()
+            current_date = today or datetime.date.today()
             if current_date != self.trading_date:
                 log.info("交易日變更: %s → %s", self.trading_date, current_date)
                 self.sent_alerts.clear()
+                self._last_seen_ts.clear()  # 新交易日：即使行情未動也重新評估一次
                 self.trading_date = current_date
                 self.market_closed_notified = False
 
@@ -346,14 +469,16 @@ class AlertEngine:
         return "\n".join(summary) if summary else "無有效持倉"
 
     def refresh_positions(self, force: bool = False):
-        if force or time.time() - self.last_positions_update > 600:
+        if force or time.monotonic() - self.last_positions_update > 600:
             new_cfgs = self._load_from_positions()
             if new_cfgs:
                 self.cfgs = new_cfgs
+                self._rebuild_indexes()
+                self._last_seen_ts.clear()  # 持倉（成本、方向）可能已變
                 for cfg in self.cfgs.values():
                     if cfg.right in ("CALL", "PUT"):
                         self.enrich_option_contract(cfg)
-                self.last_positions_update = time.time()
+                self.last_positions_update = time.monotonic()
                 self._subscribe_market_data()
                 self._update_initial_prices()
                 summary = self.get_positions_summary()
@@ -362,9 +487,12 @@ class AlertEngine:
     def _update_initial_prices(self) -> None:
         for k, c in self.cfgs.items():
             self.init_price[k] = c.premium
-        for symbol in {cfg.symbol for cfg in self.cfgs.values()}:
+        deadline = time.monotonic() + 10.0
+        for symbol in self._underlying_symbols:
             if symbol not in self.prev_closes:
-                prev_close = self._get_underlying_prev_close(symbol)
+                prev_close = self._get_underlying_prev_close(
+                    symbol, max(0.0, deadline - time.monotonic())
+                )
                 if prev_close:
                     self.prev_closes[symbol] = prev_close
                     log.debug("更新 %s 昨收價格: %.2f", symbol, prev_close)
@@ -372,53 +500,78 @@ class AlertEngine:
     def _get_underlying_prev_close(
         self, symbol: str, timeout: float = 10.0
     ) -> Optional[float]:
-        t0 = time.monotonic()
-        while time.monotonic() - t0 < timeout:
-            data = self.app.get_stream_data(symbol)
-            close_val = data.get("prev_close") or data.get("close")
-            if close_val:
-                return close_val
-            time.sleep(0.1)
-        return None
+        return self.app.wait_for_close(symbol, timeout)
 
     # ─────────── 警報文字 ───────────
+    # 固定模板在類別層級建一次，每則警報只做 str.format
+    _TPL_DELTA_SELL = "{key} Δ={value:.3f}（SELL）已超過閾值 {th:.2f}"
+    _TPL_DELTA_SELL_ACTION = "建議關注 {symbol} {strike}{right} 風險增加"
+    _TPL_DELTA_BUY = "{key} Δ={value:.3f}（BUY）已低於門檻 {th:.2f}"
+    _DELTA_BUY_ACTION = "留意部位敏感度下降（可評估調整或加值）"
+    _TPL_PROFIT = (
+        "{key} 收益={value:.1%} 已達目標 {target:.1%} "
+        "({action} {premium:.2f}→{price:.2f})"
+    )
+    _PROFIT_ACTION = ("可考慮賣出平倉獲利", "可考慮買回平倉獲利")  # 依 is_sell 取
+    _TPL_DTE = "{key} 剩餘天數={value} 低於設定 {min_dte}"
+    _DTE_ACTION = "注意時間價值加速衰減，評估是否調整部位"
+    _TPL_GAP = "{key} {direction} {value:.1%}，大幅變動"
+    _GAP_ACTION = (  # 依 value > 0 取
+        "請密切關注市場波動，CALL選擇權可能受影響較大",
+        "請密切關注市場波動，PUT選擇權可能受影響較大",
+    )
+
     def generate_detailed_alert(
         self,
         key: str,
         alert_type: str,
         value: float,
-        contract: ContractConfig,
+        contract: ContractConfig | None,
         extra_info: dict | None = None,
+        today: str | None = None,
     ) -> tuple[str, str]:
+        # today（YYYY-MM-DD 標頭）可由呼叫端每輪算一次傳入，同輪多則警報共用
+        # gap 警報只用 key（即標的代號），contract 傳 None 即可
         extra_info = extra_info or {}
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
+        today = today or datetime.datetime.now().strftime("%Y-%m-%d")
 
         if alert_type == "delta":
             emoji = "🚨"
-            mode = extra_info.get("mode", contract.action.upper())  # "SELL" or "BUY"
+            mode = extra_info.get("mode", contract.action)  # "SELL" or "BUY"
             th = extra_info.get("threshold", 0.30)
             if mode == "SELL":
-                detail = f"{key} Δ={value:.3f}（SELL）已超過閾值 {th:.2f}"
-                action = f"建議關注 {contract.symbol} {contract.strike}{'P' if contract.right=='PUT' else 'C'} 風險增加"
+                detail = self._TPL_DELTA_SELL.format(key=key, value=value, th=th)
+                action = self._TPL_DELTA_SELL_ACTION.format(
+                    symbol=contract.symbol,
+                    strike=contract.strike,
+                    right=_RIGHT_ABBR[contract.right],
+                )
             else:
-                detail = f"{key} Δ={value:.3f}（BUY）已低於門檻 {th:.2f}"
-                action = f"留意部位敏感度下降（可評估調整或加值）"
+                detail = self._TPL_DELTA_BUY.format(key=key, value=value, th=th)
+                action = self._DELTA_BUY_ACTION
         elif alert_type == "profit":
             emoji = "💰"
-            detail = (
-                f"{key} 收益={value:.1%} 已達目標 {extra_info.get('target', 0.5):.1%} "
-                f"({contract.action} {contract.premium:.2f}→{extra_info.get('price', 0):.2f})"
+            detail = self._TPL_PROFIT.format(
+                key=key,
+                value=value,
+                target=extra_info.get("target", 0.5),
+                action=contract.action,
+                premium=contract.premium,
+                price=extra_info.get("price", 0),
             )
-            action = f"可考慮{'買回' if contract.action=='SELL' else '賣出'}平倉獲利"
+            action = self._PROFIT_ACTION[contract.is_sell]
         elif alert_type == "dte":
             emoji = "📅"
-            detail = f"{key} 剩餘天數={value} 低於設定 {extra_info.get('min_dte', 36)}"
-            action = "注意時間價值加速衰減，評估是否調整部位"
+            detail = self._TPL_DTE.format(
+                key=key, value=value, min_dte=extra_info.get("min_dte", 36)
+            )
+            action = self._DTE_ACTION
         else:  # gap
             emoji = "⚡"
-            direction = "上漲" if value > 0 else "下跌"
-            detail = f"{key} {direction} {abs(value):.1%}，大幅變動"
-            action = f"請密切關注市場波動，{'PUT' if value > 0 else 'CALL'}選擇權可能受影響較大"
+            detail = self._TPL_GAP.format(
+                key=key, direction="上漲" if value > 0 else "下跌", value=abs(value)
+            )
+            action = self._GAP_ACTION[value > 0]
 
         full_message = f"{emoji} {today}\n{detail}\n{action}"
         unique_id = f"{alert_type}_{key}_{self.trading_date:%Y%m%d}"
@@ -437,10 +590,14 @@ class AlertEngine:
                 c.multiplier,
             )
 
-    def _pick_price(self, d: dict):
+    @staticmethod
+    def _pick_price(d: Mapping[str, Any]) -> Optional[float]:
         # 依序嘗試：標準 last/bid/ask → 延遲 p68/p66/p67 → Mark Price p37
-        for k in ("last", "bid", "ask", "p68", "p66", "p67", "p37"):
-            v = d.get(k)
+        get = d.get
+        for k in _PICK_PRICE_KEYS:
+            v = get(k)
+            if v is None:
+                continue  # 最常見的落空情況，免做型別檢查
             if isinstance(v, (int, float)) and v > 0:
                 return v
         return None
@@ -451,38 +608,59 @@ class AlertEngine:
 
         while True:
             try:
+                cycle_start = time.monotonic()
+                # 每輪只讀一次時鐘，往下傳給日期判斷與 DTE
+                now_dt = datetime.datetime.now()
+                today = now_dt.date()
+                today_str = now_dt.strftime("%Y-%m-%d")
                 self.refresh_positions()
-                if not self._check_market_status():
+                if not self._check_market_status(today):
                     time.sleep(CHECK_INTERVAL * 5)
                     continue
 
                 self.market_closed_notified = False
-                log.debug(
-                    "[%s] 開始檢查合約狀態",
-                    datetime.datetime.now().strftime("%H:%M:%S"),
-                )
+                # 每輪判斷一次；未啟用 DEBUG 時整段 debug 格式化（含 strftime）都略過
+                debug_on = log.isEnabledFor(logging.DEBUG)
+                if debug_on:
+                    log.debug("[%s] 開始檢查合約狀態", now_dt.strftime("%H:%M:%S"))
                 alerts: list[tuple[str, str]] = []
+                detail_lines: list[str] = []
+                symbols = self._underlying_symbols
+                snap = self.app.get_stream_data_many(self._stream_keys)
 
                 # 股票行情 / 跳空
-                for symbol in {cfg.symbol for cfg in self.cfgs.values()}:
-                    data = self.app.get_stream_data(symbol)
+                for symbol in symbols:
+                    data = snap[symbol]
                     stock_px = data.get("last") or data.get("bid") or data.get("ask")
                     prev_close = self.prev_closes.get(symbol)
                     if stock_px and prev_close:
                         gap = (stock_px - prev_close) / prev_close
-                        log.debug("%s Px=%.2f", symbol, stock_px)
+                        if debug_on:
+                            log.debug("%s Px=%.2f", symbol, stock_px)
                         if abs(gap) >= 0.03:
                             msg, aid = self.generate_detailed_alert(
-                                symbol, "gap", gap, ContractConfig(symbol, "", 0, "")
+                                symbol,
+                                "gap",
+                                gap,
+                                None,
+                                today=today_str,
                             )
                             alerts.append((msg, aid))
                             log.warning("偵測到 %s 跳空: %.1f%%", symbol, gap * 100)
-                    else:
+                    elif debug_on:
                         log.debug("%s Px=NA", symbol)
 
-                # 選擇權逐檔
-                for key, c in self.cfgs.items():
-                    data = self.app.get_stream_data(key)
+                # 選擇權逐檔（門檻每輪取一次成區域變數）
+                sell_thr = getattr(self.rule, "sell_delta_threshold", 0.30)
+                buy_floor = getattr(self.rule, "buy_delta_floor", 0.65)
+                profit_target = self.rule.profit_target
+                min_dte = self.rule.min_dte
+                last_seen = self._last_seen_ts
+                # 本輪評估過的 (key, _ts)：警報排入推播後才記入 last_seen，
+                # 中途出例外時下一輪會重新評估，不會因此吞掉警報
+                evaluated: list[tuple[str, Any]] = []
+                for key, c in self._cfg_items:
+                    data = snap[key]
                     price = self._pick_price(data)
                     delta = data.get("delta")
                     iv = data.get("iv")
@@ -490,82 +668,95 @@ class AlertEngine:
                         log.warning("%s: 無法取得完整資料, data: %s", key, data)
                         continue
 
-                    dte = self._dte(c.expiry)
+                    dte = (_expiry_date(c.expiry) - today).days
                     delta_abs = abs(delta)
-                    is_sell = c.action.upper() == "SELL"
-                    sell_thr = getattr(self.rule, "sell_delta_threshold", 0.30)
-                    buy_floor = getattr(self.rule, "buy_delta_floor", 0.65)
+                    is_sell = c.is_sell
+
+                    # 行情自上輪未再發佈：Δ／收益結果與上輪相同（已去重），
+                    # 只需檢查隨日期變化的 DTE
+                    ts = data.get("_ts")
+                    fresh = ts is None or ts != last_seen.get(key)
+                    if fresh:
+                        evaluated.append((key, ts))
+
+                        # Δ 門檻
+                        # SELL：|Δ| >= 0.30 才警報
+                        if is_sell and delta_abs >= sell_thr:
+                            msg, aid = self.generate_detailed_alert(
+                                key,
+                                "delta",
+                                delta_abs,
+                                c,
+                                {"threshold": sell_thr, "mode": "SELL"},
+                                today=today_str,
+                            )
+                            alerts.append((msg, aid))
+                            log.warning(
+                                "%s Δ=%.3f (SELL) 超過 %.2f", key, delta_abs, sell_thr
+                            )
 
-                    # Δ 門檻
-                    # SELL：|Δ| >= 0.30 才警報
-                    if is_sell and delta_abs >= sell_thr:
-                        msg, aid = self.generate_detailed_alert(
-                            key,
-                            "delta",
-                            delta_abs,
-                            c,
-                            {"threshold": sell_thr, "mode": "SELL"},
-                        )
-                        alerts.append((msg, aid))
-                        log.warning(
-                            "%s Δ=%.3f (SELL) 超過 %.2f", key, delta_abs, sell_thr
-                        )
+                        # BUY：|Δ| <= 0.65 才警報
+                        elif (not is_sell) and delta_abs <= buy_floor and delta_abs > 0:
+                            msg, aid = self.generate_detailed_alert(
+                                key,
+                                "delta",
+                                delta_abs,
+                                c,
+                                {"threshold": buy_floor, "mode": "BUY"},
+                                today=today_str,
+                            )
+                            alerts.append((msg, aid))
+                            log.warning(
+                                "%s Δ=%.3f (BUY) 低於 %.2f", key, delta_abs, buy_floor
+                            )
 
-                    # BUY：|Δ| <= 0.65 才警報
-                    elif (not is_sell) and delta_abs <= buy_floor and delta_abs > 0:
-                        msg, aid = self.generate_detailed_alert(
-                            key,
-                            "delta",
-                            delta_abs,
-                            c,
-                            {"threshold": buy_floor, "mode": "BUY"},
-                        )
-                        alerts.append((msg, aid))
-                        log.warning(
-                            "%s Δ=%.3f (BUY) 低於 %.2f", key, delta_abs, buy_floor
-                        )
+                        # 收益率（僅針對賣方部位觸發）
+                        base = abs(c.premium) or 1e-9
+                        if is_sell:
+                            pct = (base - price) / base
+                        else:
+                            pct = (price - base) / base
 
-                    # 收益率（僅針對賣方部位觸發）
-                    base = abs(c.premium) or 1e-9
-                    if c.action.upper() == "SELL":
-                        pct = (base - price) / base
-                    else:
-                        pct = (price - base) / base
+                        # 僅當為賣方部位（SELL）且達到獲利目標時才發出警報
+                        if is_sell and pct >= profit_target:
+                            msg, aid = self.generate_detailed_alert(
+                                key,
+                                "profit",
+                                pct,
+                                c,
+                                {"target": profit_target, "price": price},
+                                today=today_str,
+                            )
+                            alerts.append((msg, aid))
+                            log.warning("%s 收益=%.1f%% 已達目標", key, pct * 100)
 
-                    # 僅當為賣方部位（SELL）且達到獲利目標時才發出警報
-                    if is_sell and pct >= self.rule.profit_target:
+                    # DTE
+                    if dte <= min_dte:
                         msg, aid = self.generate_detailed_alert(
                             key,
-                            "profit",
-                            pct,
+                            "dte",
+                            dte,
                             c,
-                            {"target": self.rule.profit_target, "price": price},
+                            {"min_dte": min_dte},
+                            today=today_str,
                         )
                         alerts.append((msg, aid))
-                        log.warning("%s 收益=%.1f%% 已達目標", key, pct * 100)
+                        log.warning("%s DTE=%d 低於閾值", key, dte)
 
-                    # DTE
-                    if dte <= self.rule.min_dte:
-                        msg, aid = self.generate_detailed_alert(
-                            key, "dte", dte, c, {"min_dte": self.rule.min_dte}
+                    if not fresh:
+                        continue
+
+                    # 詳細行情（維持原先 debug 資訊格式；未啟用 DEBUG 時不做格式化）
+                    # 逐檔收集，整輪結束後合併成一筆 log
+                    if debug_on:
+                        iv_str = f"{iv:.4f}" if iv else "NA"
+                        detail_lines.append(
+                            f"{key}: Px={price:.2f} ({pct:+.1%}) Δ={delta_abs:.3f} "
+                            f"(ΔΔ={delta_abs - abs(c.delta):+.3f}) IV={iv_str} DTE={dte}"
                         )
-                        alerts.append((msg, aid))
-                        log.warning("%s DTE=%d 低於閾值", key, dte)
 
-                    # 詳細行情（維持原先 debug 資訊格式）
-                    pct_str = f"{pct:+.1%}"
-                    delta_diff = f"{delta_abs - abs(c.delta):+.3f}"
-                    iv_str = f"{iv:.4f}" if iv else "NA"
-                    log.debug(
-                        "%s: Px=%.2f (%s) Δ=%.3f (ΔΔ=%s) IV=%s DTE=%d",
-                        key,
-                        price,
-                        pct_str,
-                        delta_abs,
-                        delta_diff,
-                        iv_str,
-                        dte,
-                    )
+                if detail_lines:
+                    log.debug("合約行情:\n%s", "\n".join(detail_lines))
 
                 # 推播警報（去重）
                 if alerts:
@@ -573,16 +764,18 @@ class AlertEngine:
                     for msg, aid in alerts:
                         if aid not in self.sent_alerts:
                             unique_alerts.append(msg)
-                            self.sent_alerts[aid] = self.trading_date
-                            line_push(msg)
+                            self.sent_alerts.add(aid)
                         else:
                             log.debug("[重複警報已忽略] %s", aid)
                     if unique_alerts:
+                        line_push(unique_alerts)
                         log.info("已發送 %d 則新警報", len(unique_alerts))
                 else:
                     log.debug("✓ 無警報")
+                last_seen.update(evaluated)
 
-                time.sleep(CHECK_INTERVAL)
+                # 扣掉本輪耗時，維持固定 CHECK_INTERVAL 週期不漂移
+                time.sleep(max(0.0, CHECK_INTERVAL - (time.monotonic() - cycle_start)))
             except Exception:
                 log.exception("主循環發生未處理例外，60 秒後重試")
                 time.sleep(60)
@@ -52,6 +52,7 @@ if not app.ready.wait(5):
 
 
 app.reqMarketDataType(MarketDataTypeEnum.DELAYED)  # 等同 app.reqMarketDataType(3)
+app.warmup_trading_calendar()  # 預取 SPY 交易時間，市場狀態檢查不必再等 IB 回覆
 
 # ---------- 啟動警報引擎（行為不變） ---------- #
 rule = StrategyConfig()